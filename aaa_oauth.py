@@ -1,10 +1,18 @@
-import copy
-import inspect
-from typing import Any, Literal, Optional
+import asyncio
+import functools
+import hashlib
+from time import time
+from types import MappingProxyType
+from typing import Any, Literal, Mapping, NamedTuple, Optional
 
 import aiohttp
 
-from pydantic import BaseModel, Field
+try:
+    import orjson as _json
+except ImportError:
+    import json as _json
+
+from pydantic import BaseModel, ConfigDict, Field, field_validator
 from pydantic_settings import BaseSettings
 from fastapi import Depends, HTTPException, Request
 from fastapi.security import OAuth2
@@ -29,35 +37,85 @@ class OAuthSettings(BaseSettings):
     user_cache_size: int = 999
     user_info_endpoint: str = ""  # Url to the user info data, e.g. 'https://login.bbmri-eric.eu/oidc/userinfo'
 
+    @field_validator("idp_url")
+    @classmethod
+    def _strip_idp_url(cls, v: str) -> str:
+        return v.rstrip("/")
+
+
+def _hash(s: str) -> bytes:
+    """Short digest used as cache key instead of long token / subject strings"""
+    return hashlib.blake2b(s.encode(), digest_size=16).digest()
+
+
+@functools.lru_cache(maxsize=None)
+def _get_settings(cls):
+    return cls()
+
 
 class BaseJwtTokenModel(BaseModel):
+    # decoded tokens are cached and shared between requests with the same token, so they are read-only
+    model_config = ConfigDict(frozen=True)
+
     sub: str
     exp: int
 
 
-class TokenPayload(BaseModel):
+class TokenPayload(NamedTuple):
     payload: str
     data: BaseJwtTokenModel
-    raw_data: dict
+    raw_data: Mapping[str, Any]  # read-only view of the claims, nested values must not be mutated either
 
 
-class Payload(BaseModel):
+class Payload(NamedTuple):
     token: TokenPayload
     request: Any = None
 
 
-def make_oauth2_wrapper(auth: Auth, auth_settings: OAuthSettings):
-    oauth2_scheme = OAuth2(
+TOKEN_CACHE_SIZE = 1024
+TOKEN_CACHE_TIMEOUT = 300  # seconds
+INVALID_TOKEN_CACHE_SIZE = 2048
+INVALID_TOKEN_CACHE_TIMEOUT = 30  # seconds
+
+
+@functools.lru_cache(maxsize=None)
+def _build_oauth2_scheme(token_url: str, auth_url: str) -> OAuth2:
+    return OAuth2(
         flows=OAuthFlows(
-            authorizationCode=OAuthFlowAuthorizationCode(
-                tokenUrl=auth_settings.openapi_token_url, authorizationUrl=auth_settings.openapi_auth_url
-            )
+            authorizationCode=OAuthFlowAuthorizationCode(tokenUrl=token_url, authorizationUrl=auth_url)
         )
     )
 
+
+def make_oauth2_wrapper(auth: Auth, auth_settings: OAuthSettings):
+    oauth2_scheme = _build_oauth2_scheme(auth_settings.openapi_token_url, auth_settings.openapi_auth_url)
+
+    # decoded tokens are cached per wrapper, since validity depends on the audience / acr settings of the auth
+    token_cache = LRUTimeoutCache(TOKEN_CACHE_SIZE, TOKEN_CACHE_TIMEOUT)
+    # rejected tokens are remembered shortly, so that replays are refused without verifying them again
+    invalid_token_cache = LRUTimeoutCache(INVALID_TOKEN_CACHE_SIZE, INVALID_TOKEN_CACHE_TIMEOUT)
+
     def oauth2_wrapper(request: Request, token=Depends(oauth2_scheme)):
-        decoded_token = auth.decode_token(token)
-        token_payload = TokenPayload(payload=token, data=decoded_token, raw_data=decoded_token)
+        key = _hash(token)
+        token_payload = token_cache.get_item(key)
+        if token_payload is None:
+            rejection = invalid_token_cache.get_item(key)
+            if rejection is not None:
+                raise HTTPException(status_code=401, detail=rejection)
+            try:
+                decoded_token = auth.decode_token(token)
+            except HTTPException as e:
+                # do not remember tokens rejected only because the server could not reach the IdP yet
+                if auth._last_time_updated is not None:
+                    invalid_token_cache.put_item(key, e.detail)
+                raise
+            token_payload = TokenPayload(
+                payload=token,
+                data=BaseJwtTokenModel.model_validate(decoded_token),
+                raw_data=MappingProxyType(decoded_token),
+            )
+            # never keep the token cached past its own expiration
+            token_cache.put_item(key, token_payload, ttl=min(TOKEN_CACHE_TIMEOUT, token_payload.data.exp - time()))
         return Payload(token=token_payload, request=request)
 
     return oauth2_wrapper
@@ -74,6 +132,33 @@ class LoggerNoLog:
         pass
 
 
+_NO_LOG = LoggerNoLog()
+
+
+def _build_auth(idp_url, audience, refresh_interval, acr_values, rewrite_url, logger):
+    return Auth(
+        idp_url=idp_url,
+        refresh_interval=refresh_interval,
+        audience=audience,
+        acr_values=acr_values,
+        logger=logger,
+        rewrite_url_in_wellknown=rewrite_url,
+    )
+
+
+_get_shared_auth = functools.lru_cache(maxsize=16)(_build_auth)
+
+
+def _get_auth(idp_url, audience, refresh_interval, acr_values, rewrite_url, logger):
+    # Auth logs through the logger, so it is shared only between integrations using the same logger;
+    # loggers that cannot be hashed (e.g. defining __eq__ only) get their own Auth
+    try:
+        hash(logger)
+    except TypeError:
+        return _build_auth(idp_url, audience, refresh_interval, acr_values, rewrite_url, logger)
+    return _get_shared_auth(idp_url, audience, refresh_interval, acr_values, rewrite_url, logger)
+
+
 class OAuthIntegration:
     """
     OAuth Integration:
@@ -89,60 +174,105 @@ class OAuthIntegration:
 
     def __init__(self, settings, logger=None, auth_settings=OAuthSettings, headers=None):
         self.headers = {} if headers is None else headers
+        self._session: Optional[aiohttp.ClientSession] = None
+        self._inflight: dict[bytes, asyncio.Future] = {}
         self.settings = settings
-        self.logger = logger if logger is not None else LoggerNoLog()
-        self.auth_settings = auth_settings() if inspect.isclass(auth_settings) else auth_settings
+        self.logger = logger if logger is not None else _NO_LOG
+        self.auth_settings = _get_settings(auth_settings) if isinstance(auth_settings, type) else auth_settings
         if not isinstance(self.auth_settings, OAuthSettings):
             raise HTTPException(status_code=500, detail="OAuth Settings must be a subclass of OAuthSettings class!")
 
-        self.auth = Auth(
-            idp_url=self.auth_settings.idp_url.rstrip("/"),
-            refresh_interval=self.auth_settings.refresh_interval,
-            audience=self.auth_settings.audience,
-            acr_values=self.auth_settings.check_acr_values,
-            logger=self.logger,
-            rewrite_url_in_wellknown=self.auth_settings.rewrite_url_in_wellknown,
+        # integrations with the same IdP configuration share one Auth and its well-known / public keys state
+        self.auth = _get_auth(
+            self.auth_settings.idp_url,
+            self.auth_settings.audience,
+            self.auth_settings.refresh_interval,
+            self.auth_settings.check_acr_values,
+            self.auth_settings.rewrite_url_in_wellknown,
+            self.logger,
         )
         self.oauth2_wrapper = make_oauth2_wrapper(auth=self.auth, auth_settings=self.auth_settings)
+        self._has_userinfo = bool(self.auth_settings.user_info_endpoint)
         if self.auth_settings.user_cache_size:
             self.user_cache = LRUTimeoutCache(self.auth_settings.user_cache_size, self.auth_settings.user_cache_timeout)
 
     def global_depends(self):
         return Depends(self.oauth2_wrapper)
 
-    async def fetch_user_info(self, auth_payload: Payload) -> str:
+    async def _get_session(self) -> aiohttp.ClientSession:
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                timeout=aiohttp.ClientTimeout(total=10),
+                connector=aiohttp.TCPConnector(limit=100, ttl_dns_cache=300),
+            )
+        return self._session
+
+    async def aclose(self):
+        """
+        Close the HTTP session shared by fetch(...), e.g. from the FastAPI shutdown event
+        """
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+
+    async def fetch_user_info(self, auth_payload: Payload) -> bytes:
         """
         Override this method to change how the user info is fetched
         """
-        return await self.fetch(self.auth_settings.user_info_endpoint, "GET", auth_payload)
+        return await self.fetch(
+            self.auth_settings.user_info_endpoint, "GET", auth_payload, raw=True, check_status=True
+        )
 
-    def parse_user_info(self, data: str):
+    def parse_user_info(self, data: str | bytes):
         """
-        Override this method to change how the user info is parsed from a string response
+        Override this method to change how the user info is parsed from the response.
+        Receives the raw response body as bytes from the default fetch_user_info (not str), by default it is
+        parsed as JSON (using orjson if installed) and a body that is not valid JSON is answered with 502.
         """
-        return data
+        try:
+            return _json.loads(data)
+        except ValueError as e:
+            raise HTTPException(status_code=502, detail="User info response is not valid JSON.") from e
 
     async def get_user_info(self, auth_payload: Payload):
+        if not self._has_userinfo:
+            return auth_payload
         token = auth_payload.token.data
         if not token.sub:
             raise HTTPException(status_code=401, detail="Auth payload does not contain 'sub' subject ID!")
-        if not self.auth_settings.user_info_endpoint:
-            return auth_payload
 
-        user_info = self.user_cache.get_item(token.sub)
-        if not user_info:
-            user_info = self.parse_user_info(await self.fetch_user_info(auth_payload))
-            self.user_cache.put_item(token.sub, user_info)
+        key = _hash(token.sub)
+        user_info = self.user_cache.get_item(key)
+        if user_info:
+            return user_info
+
+        # concurrent misses for the same subject share a single fetch, run as its own task and shielded,
+        # so that a cancelled (e.g. disconnected) request does not cancel it for the other waiters
+        inflight = self._inflight.get(key)
+        if inflight is None:
+            inflight = asyncio.ensure_future(self._fetch_and_cache_user_info(auth_payload, key))
+            self._inflight[key] = inflight
+            inflight.add_done_callback(functools.partial(self._inflight_done, key))
+        return await asyncio.shield(inflight)
+
+    async def _fetch_and_cache_user_info(self, auth_payload: Payload, key: bytes):
+        user_info = self.parse_user_info(await self.fetch_user_info(auth_payload))
+        remaining = auth_payload.token.data.exp - int(time())
+        self.user_cache.put_item(key, user_info, ttl=min(self.auth_settings.user_cache_timeout, remaining))
         return user_info
 
+    def _inflight_done(self, key: bytes, task: asyncio.Future):
+        if self._inflight.get(key) is task:
+            del self._inflight[key]
+        # mark the exception as retrieved in case all waiters were cancelled
+        if not task.cancelled():
+            task.exception()
+
     def build_request_headers(self, auth_payload: Payload) -> dict[str, str]:
         """Build Authorization header from payload, preserving existing headers. Used in fetch(...)"""
-        headers = copy.copy(self.headers)
         token = auth_payload.token.payload
-        headers["Authorization"] = (
-            f"Bearer {token}" if not token.startswith("Bearer") else token
-        )
-        return headers
+        auth_value = token if token.startswith("Bearer ") else f"Bearer {token}"
+        return {**self.headers, "Authorization": auth_value}
 
     async def fetch(
         self,
@@ -151,20 +281,29 @@ class OAuthIntegration:
         auth_payload: Payload | None = None,
         data: Any | None = None,
         headers: dict | None = None,
-    ) -> str:
+        raw: bool = False,
+        check_status: bool = False,
+    ) -> str | bytes:
         """
-        Low-level helper that performs the actual HTTP request
+        Low-level helper that performs the actual HTTP request, returns the response body as bytes if raw is set.
+        With check_status, an error status is raised as 401 (token rejected by the server) or 502 (other errors).
         """
         if not headers:
             if not auth_payload:
                 raise ValueError("No auth payload provided when headers are not provided")
             headers = self.build_request_headers(auth_payload)
 
-        async with aiohttp.ClientSession() as session:
-            async with session.request(
-                method,
-                url,
-                headers=headers,
-                json=data if method == "POST" and data is not None else None,
-            ) as response:
-                return await response.text()
+        session = await self._get_session()
+        async with session.request(
+            method,
+            url,
+            headers=headers,
+            json=data if method == "POST" and data is not None else None,
+        ) as response:
+            if check_status and response.status >= 400:
+                if response.status in (401, 403):
+                    raise HTTPException(status_code=401, detail="Token rejected by the requested server.")
+                raise HTTPException(status_code=502, detail=f"Requested server responded with {response.status}.")
+            if raw:
+                return await response.read()
+            return await response.text()
@@ -1,60 +1,110 @@
 import asyncio
-from collections import OrderedDict
+import heapq
+import threading
+import time
 
 
 class LRUTimeoutCache:
+    """
+    LRU cache with a timeout per entry, shared between async tasks and threadpool workers.
+    Hits are lock-free: entries are only moved to the recent end once they fall into the oldest quarter
+    of insertion order (approximated by an insertion counter), mutations are guarded by a lock.
+    Expired entries are dropped on access, on insert and by a periodic sweep task started on the running
+    event loop on the first insert made from it. Both evict through a heap ordered by expiration time.
+    """
+
     def __init__(self, size, timeout):
-        self.event_loop = asyncio.get_event_loop()
-        self.cache = OrderedDict()
+        self.cache = {}
         self.maxSize = size
         self.timeout = timeout
+        self._counter = 0
+        self._promote_age = max(1, size * 3 // 4)
+        self._lock = threading.Lock()
+        self._heap = []
+        self._sweep_task = None
 
     def get_all(self):
         return self.cache
 
     def has_item(self, key):
-        return key in self.cache
+        item = self.cache.get(key)
+        return item is not None and item["exp"] >= time.monotonic()
 
     def get_item(self, key):
-        if key not in self.cache:
+        item = self.cache.get(key)
+        if item is None:
+            return None
+        if item["exp"] < time.monotonic():
+            with self._lock:
+                if self.cache.get(key) is item:
+                    del self.cache[key]
             return None
-        self.cache.move_to_end(key)
-        item = self.cache[key]
-        self._update_timer(item, key)
+        if self._counter - item["seq"] >= self._promote_age:
+            with self._lock:
+                if self.cache.get(key) is item:
+                    del self.cache[key]
+                    self._counter += 1
+                    item["seq"] = self._counter
+                    self.cache[key] = item
         return item["data"]
 
-    def put_item(self, key, item):
-        if key in self.cache:
-            existing_item = self.cache[key]
-            existing_item["timer"].cancel()
-            existing_item["timer"] = None
-
-        cache_item = {
-            "timer": None,
-            "data": item
-        }
-
-        self._update_timer(cache_item, key)
-        self.cache[key] = cache_item
-        self.cache.move_to_end(key)
-
-        if len(self.cache) > self.maxSize:
-            removed_item = self.cache.popitem(last=False)
-            removed_item["timer"].cancel()
-            removed_item["timer"] = None
-            return removed_item["data"]
+    def put_item(self, key, item, ttl=None):
+        """Store item, ttl overrides the cache timeout for this entry (seconds)"""
+        now = time.monotonic()
+        exp = now + (self.timeout if ttl is None else ttl)
+        with self._lock:
+            self._evict_expired(now)
+            self._counter += 1
+            # re-insert so that the key moves to the recent end
+            self.cache.pop(key, None)
+            self.cache[key] = {
+                "data": item,
+                "exp": exp,
+                "seq": self._counter
+            }
+            # the counter breaks ties, so that keys themselves are never compared
+            heapq.heappush(self._heap, (exp, self._counter, key))
 
-    def _update_timer(self, item, key):
-        timer = item["timer"]
-        if timer is not None:
-            timer.cancel()
-        item["timer"] = self.event_loop.call_later(self.timeout, self._delete_outdated,key)
+            removed_item = self.cache.pop(next(iter(self.cache))) if len(self.cache) > self.maxSize else None
+            if len(self._heap) > 2 * len(self.cache) + self.maxSize:
+                self._rebuild_heap()
 
-    def _delete_outdated(self, key):
-        del self.cache[key]
+        self._start_sweep()
+        if removed_item is not None:
+            return removed_item["data"]
 
     def pop_item(self):
-        removed_item = self.cache.popitem(last=True)
-        removed_item["timer"].cancel()
-        removed_item["timer"] = None
-        return removed_item["data"]
+        with self._lock:
+            _, removed_item = self.cache.popitem()
+            return removed_item["data"]
+
+    def _evict_expired(self, now):
+        # heap entries of replaced or evicted items are stale, only drop the entry if it still expires then
+        heap = self._heap
+        while heap and heap[0][0] < now:
+            exp, _, key = heapq.heappop(heap)
+            item = self.cache.get(key)
+            if item is not None and item["exp"] == exp:
+                del self.cache[key]
+
+    def _rebuild_heap(self):
+        # drops the stale entries of replaced or evicted items, keeps the heap bounded by the cache size
+        self._heap = [(item["exp"], item["seq"], key) for key, item in self.cache.items()]
+        heapq.heapify(self._heap)
+
+    def _start_sweep(self):
+        if self._sweep_task is not None and not self._sweep_task.done():
+            return
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            # not called from the event loop thread (e.g. a threadpool dependency), expire on access / insert only
+            return
+        self._sweep_task = asyncio.create_task(self._sweep())
+
+    async def _sweep(self):
+        interval = self.timeout / 10
+        while self._heap:
+            await asyncio.sleep(interval)
+            with self._lock:
+                self._evict_expired(time.monotonic())